@@ -1,3 +1,10 @@
-from wholeftbot.start import WhoLeftBot
+import sys
 
-WhoLeftBot().start()
+if len(sys.argv) > 1 and sys.argv[1] == "export":
+    from wholeftbot.export import main
+
+    main(sys.argv[2:])
+else:
+    from wholeftbot.start import WhoLeftBot
+
+    WhoLeftBot().start()
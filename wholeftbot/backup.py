@@ -0,0 +1,135 @@
+import datetime
+import glob
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Callable, List, Optional
+
+from wholeftbot.database import Database
+
+
+class BackupScheduler:
+    """
+    Makes compressed online snapshots of the database in background
+    """
+
+    FILE_PREFIX = "backup-"
+    FILE_SUFFIX = ".sqlite.gz"
+    PAGES_PER_STEP = 256
+    STEP_SLEEP = 0.05
+
+    def __init__(self, db: Database, backup_dir: str, interval_hours=0, keep=7):
+        """
+        :param db: Database
+        :param backup_dir: directory for snapshots
+        :param interval_hours: hours between scheduled backups, 0 for on-demand only
+        :param keep: number of snapshots to keep
+        """
+        self.db: Database = db
+        self.backup_dir: str = backup_dir
+        self.interval: Optional[float] = (
+            interval_hours * 60 * 60 if interval_hours > 0 else None
+        )
+        self.keep: int = keep
+
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable] = []
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="backup", daemon=True)
+        thread.start()
+        return thread
+
+    def trigger(self, callback: Optional[Callable] = None):
+        """
+        Request a backup as soon as possible
+        :param callback: called with (path, exception) when backup is finished
+        :return:
+        """
+        with self._lock:
+            if callback:
+                self._callbacks.append(callback)
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait(self.interval)
+            self._event.clear()
+            with self._lock:
+                callbacks, self._callbacks = self._callbacks, []
+
+            path, error = None, None
+            try:
+                path = self.run_once()
+                logging.info(f"Database backup saved to {path}")
+            except Exception as ex:  # pylint: disable=W0703
+                error = ex
+                logging.error(f"Database backup failed: {ex}")
+
+            for callback in callbacks:
+                try:
+                    callback(path, error)
+                except Exception as ex:  # pylint: disable=W0703
+                    logging.error(f"Backup callback failed: {ex}")
+
+    def run_once(self) -> str:
+        """
+        Make a snapshot, check it and compress it
+        :return: path of compressed snapshot
+        """
+        os.makedirs(self.backup_dir, exist_ok=True)
+
+        # Backups triggered within the same second must not share file names
+        name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        path = os.path.join(self.backup_dir, self.FILE_PREFIX + name + self.FILE_SUFFIX)
+        snapshot_path = os.path.join(self.backup_dir, f".{name}.sqlite")
+        compressed_path = path + ".tmp"
+
+        try:
+            self.db.backup(snapshot_path, self.PAGES_PER_STEP, self.STEP_SLEEP)
+            self._check_snapshot(snapshot_path)
+
+            with open(snapshot_path, "rb") as src, gzip.open(
+                compressed_path, "wb"
+            ) as dst:
+                shutil.copyfileobj(src, dst)
+            self._check_compressed(compressed_path)
+
+            os.replace(compressed_path, path)
+        finally:
+            for tmp_path in (snapshot_path, compressed_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        self._rotate()
+        return path
+
+    @staticmethod
+    def _check_snapshot(path: str):
+        con = sqlite3.connect(path)
+        try:
+            result = con.execute("PRAGMA integrity_check").fetchone()[0]
+        finally:
+            con.close()
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"Integrity check failed: {result}")
+
+    @staticmethod
+    def _check_compressed(path: str):
+        # Reading to the end makes gzip verify CRC and length of the data
+        with gzip.open(path, "rb") as file:
+            while file.read(1024 * 1024):
+                pass
+
+    def _rotate(self):
+        backups = sorted(
+            glob.glob(
+                os.path.join(self.backup_dir, self.FILE_PREFIX + "*" + self.FILE_SUFFIX)
+            )
+        )
+        for path in backups[: -self.keep] if self.keep > 0 else []:
+            os.remove(path)
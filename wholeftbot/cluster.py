@@ -0,0 +1,335 @@
+import itertools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from telebot import TeleBot, apihelper
+from telebot.types import Update
+
+from wholeftbot import constants, emoji
+from wholeftbot.backup import BackupScheduler
+from wholeftbot.database import Database
+from wholeftbot.digest import DigestScheduler
+from wholeftbot.metrics import Metrics
+
+
+class DatabaseProxy(Database):
+    """
+    Database that sends writes to the writer process and reads the file directly
+    """
+
+    def __init__(self, db_path, write_queue):
+        super().__init__(db_path, readonly=True)
+        self._write_queue = write_queue
+
+    def _submit(self, method: str, *args):
+        self._write_queue.put((self.tenant_id, method, args))
+
+    def save_user_and_chat(self, user, chat):
+        self._submit("save_user_and_chat", user, chat)
+        return user.id, chat.id if chat and chat.id != user.id else None
+
+    def save_cmd(self, user, chat, cmd):
+        self._submit("save_cmd", user, chat, cmd)
+
+    def left_member_log(self, user, chat):
+        self._submit("left_member_log", user, chat)
+
+    def join_members_log(self, users, chat):
+        self._submit("join_members_log", users, chat)
+
+    def set_digest(self, chat_id, enabled):
+        self._submit("set_digest", chat_id, enabled)
+
+    def advance_digests(self, chat_ids):
+        self._submit("advance_digests", chat_ids)
+
+    def set_leave_notifications(self, chat_id, debounce_seconds):
+        self._submit("set_leave_notifications", chat_id, debounce_seconds)
+
+
+class BackupProxy:
+    """
+    Sends on-demand backups of a worker to the backup scheduler of the main process,
+    so only one process ever writes to the backup directory
+    """
+
+    def __init__(self, partition: int, requests_queue, results_queue):
+        self.partition: int = partition
+        self._requests = requests_queue
+        self._results = results_queue
+
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._callbacks: Dict[int, Callable] = {}
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="backup", daemon=True)
+        thread.start()
+        return thread
+
+    def trigger(self, callback: Optional[Callable] = None):
+        """
+        Request a backup as soon as possible
+        :param callback: called with (path, exception) when backup is finished
+        :return:
+        """
+        request_id = next(self._ids)
+        if callback:
+            with self._lock:
+                self._callbacks[request_id] = callback
+        self._requests.put((self.partition, request_id))
+
+    def _run(self):
+        while True:
+            request_id, path, error = self._results.get()
+            with self._lock:
+                callback = self._callbacks.pop(request_id, None)
+            if callback is None:
+                continue
+
+            try:
+                callback(path, RuntimeError(error) if error else None)
+            except Exception as ex:  # pylint: disable=W0703
+                logging.error(f"Backup callback failed: {ex}")
+
+
+def _is_relevant_update(update: dict) -> bool:
+    """
+    Cheap check of a raw update before it is sent to a worker
+    :param update: decoded update
+    :return: False if update should be dropped
+    """
+    message = update.get("message")
+    if not message:
+        return False
+    if "left_chat_member" in message or "new_chat_members" in message:
+        return True
+
+    entities = message.get("entities")
+    if not entities:
+        return False
+    return entities[0]["type"] == "bot_command" and entities[0]["offset"] == 0
+
+
+def _writer_main(db_path, write_queue, batch_size):
+    """
+    Writer process: the only one that writes to the database file
+    """
+    db = Database(db_path)
+    while True:
+        batch = [write_queue.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(write_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        # Whole batch is committed in a single transaction,
+        # each item is a nested one, so a failed item is rolled back alone
+        with db.transaction():
+            for item in batch:
+                if item is None:
+                    return
+                tenant_id, method, args = item
+                try:
+                    with db.transaction():
+                        getattr(db.for_tenant(tenant_id), method)(*args)
+                except Exception as ex:  # pylint: disable=W0703
+                    logging.error(f"Writer failed to execute {method}: {ex}")
+
+
+def _worker_main(
+    token,
+    db_path,
+    write_queue,
+    updates_queue,
+    partition,
+    backup_requests,
+    backup_results,
+):
+    """
+    Worker process: handles updates of its own partition of chats
+    """
+    # pylint: disable=C0415
+    from wholeftbot.telegrambot import TelegramBot
+
+    db = DatabaseProxy(db_path, write_queue)
+    tgbot = TelegramBot(token, db, register_commands=False)
+
+    # All backups are made by the scheduler of the main process
+    tgbot.backups = BackupProxy(partition, backup_requests, backup_results)
+    tgbot.backups.start()
+    while True:
+        updates = updates_queue.get()
+        if updates is None:
+            return
+        tgbot.bot.process_new_updates([Update.de_json(u) for u in updates])
+
+
+class Cluster:
+    """
+    Multi-process mode: the main process polls Telegram and dispatches updates
+    to worker processes partitioned by chat_id, one writer process owns the database
+    """
+
+    POLLING_TIMEOUT = 20
+    ERROR_INTERVAL = 5
+    WRITE_BATCH_SIZE = 100
+    # Workers see only dispatched updates, so the main process logs its own counters
+    STATS_LOG_INTERVAL = 60 * 60
+
+    def __init__(self, token, db_path, workers, backups: BackupScheduler, clean=False):
+        self.token: str = token
+        self.db_path: str = db_path
+        self.workers_count: int = workers
+        self.backups: BackupScheduler = backups
+        self.clean: bool = clean
+
+        self.write_queue = multiprocessing.Queue()
+        self.updates_queues = [multiprocessing.Queue() for _ in range(workers)]
+        self.backup_requests = multiprocessing.Queue()
+        self.backup_results = [multiprocessing.Queue() for _ in range(workers)]
+        self.writer: Optional[multiprocessing.Process] = None
+        self.workers: List[Optional[multiprocessing.Process]] = [None] * workers
+        self.offset: Optional[int] = None
+        self.metrics: Metrics = Metrics()
+        self.stats_logged_at: float = time.monotonic()
+
+    def _start_writer(self):
+        self.writer = multiprocessing.Process(
+            target=_writer_main,
+            args=(self.db_path, self.write_queue, self.WRITE_BATCH_SIZE),
+            name="wholeftbot-writer",
+            daemon=True,
+        )
+        self.writer.start()
+
+    def _start_worker(self, partition: int):
+        worker = multiprocessing.Process(
+            target=_worker_main,
+            args=(
+                self.token,
+                self.db_path,
+                self.write_queue,
+                self.updates_queues[partition],
+                partition,
+                self.backup_requests,
+                self.backup_results[partition],
+            ),
+            name=f"wholeftbot-worker-{partition}",
+            daemon=True,
+        )
+        worker.start()
+        self.workers[partition] = worker
+
+    def _serve_backups(self):
+        """
+        Trigger backups requested by workers and send them the results
+        """
+        while True:
+            partition, request_id = self.backup_requests.get()
+            results = self.backup_results[partition]
+
+            def _done(path, error, request_id=request_id, results=results):
+                results.put((request_id, path, str(error) if error else None))
+
+            self.backups.trigger(_done)
+
+    def _supervise(self):
+        """
+        Restart crashed processes
+        """
+        if not self.writer.is_alive():
+            logging.error(f"Writer exited with code {self.writer.exitcode}, restarting")
+            self._start_writer()
+
+        for partition, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                logging.error(
+                    f"Worker {partition} exited with code {worker.exitcode}, restarting"
+                )
+                self._start_worker(partition)
+
+    def _dispatch(self, updates: List[dict]):
+        partitions: Dict[int, List[dict]] = {}
+        for update in updates:
+            self.offset = update["update_id"] + 1
+            self.metrics.incr("updates.received")
+            if not _is_relevant_update(update):
+                self.metrics.incr("updates.dropped")
+                continue
+            chat_id = update["message"]["chat"]["id"]
+            partitions.setdefault(chat_id % self.workers_count, []).append(update)
+
+        for partition, batch in partitions.items():
+            self.updates_queues[partition].put(batch)
+
+    def _log_stats(self):
+        now = time.monotonic()
+        if now - self.stats_logged_at < self.STATS_LOG_INTERVAL:
+            return
+        self.stats_logged_at = now
+
+        counters = self.metrics.snapshot()
+        logging.info(
+            f"Updates received: {counters.get('updates.received', 0)}, "
+            f"dropped before dispatch: {counters.get('updates.dropped', 0)}"
+        )
+
+    def _poll(self):
+        updates = apihelper.get_updates(
+            self.token,
+            self.offset,
+            allowed_updates=["message"],
+            long_polling_timeout=self.POLLING_TIMEOUT,
+        )
+        self._dispatch(updates)
+
+    def _stop(self):
+        for updates_queue in self.updates_queues:
+            updates_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.write_queue.put(None)
+        self.writer.join()
+
+    def run(self):
+        self._start_writer()
+        for partition in range(self.workers_count):
+            self._start_worker(partition)
+        threading.Thread(
+            target=self._serve_backups, name="backup-requests", daemon=True
+        ).start()
+
+        DigestScheduler(
+            TeleBot(self.token, threaded=False),
+            DatabaseProxy(self.db_path, self.write_queue),
+        ).start()
+
+        if self.clean:
+            updates = apihelper.get_updates(self.token, -1)
+            if updates:
+                self.offset = updates[-1]["update_id"] + 1
+
+        for admin in constants.ADMINS:
+            apihelper.send_message(
+                self.token,
+                admin,
+                f"{emoji.INFO} I was restarted with {self.workers_count} workers",
+            )
+
+        try:
+            while True:
+                self._supervise()
+                self._log_stats()
+                try:
+                    self._poll()
+                except Exception as ex:  # pylint: disable=W0703
+                    logging.error(f"Polling failed: {ex}")
+                    time.sleep(self.ERROR_INTERVAL)
+        except KeyboardInterrupt:
+            self._stop()
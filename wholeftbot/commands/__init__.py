@@ -1,6 +1,9 @@
 import logging
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
 
 from telebot import TeleBot
 from telebot.apihelper import ApiException
@@ -8,6 +11,91 @@ from telebot.types import Message, CallbackQuery
 
 from wholeftbot import constants
 from wholeftbot.database import Database
+from wholeftbot.metrics import Metrics
+
+
+class ThrottlePolicy(NamedTuple):
+    # Calls per second and burst size allowed for one user
+    user_rate: float = 0.1
+    user_burst: int = 3
+    # Calls per second and burst size allowed for one chat
+    chat_rate: float = 0.2
+    chat_burst: int = 5
+
+
+# Settings of a chat are rarely changed, so commands changing them are limited harder
+SETTINGS_THROTTLE_POLICY = ThrottlePolicy(user_rate=1 / 30, user_burst=2)
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class Throttle:
+    """
+    Token buckets by user and by chat, least recently used buckets are evicted once they are idle
+    """
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, policy: ThrottlePolicy, metrics: Metrics):
+        self.policy = policy
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict = OrderedDict()
+
+    def _limits(self, key) -> Tuple[float, int]:
+        if key[0] == "user":
+            return self.policy.user_rate, self.policy.user_burst
+        return self.policy.chat_rate, self.policy.chat_burst
+
+    def _evict_idle(self, now: float) -> bool:
+        """
+        Evict the least recently used bucket if it is idle long enough to be full again,
+        so dropping it doesn't reset limits of anyone
+        :param now: current time
+        :return: False if there is no idle bucket
+        """
+        key, bucket = next(iter(self._buckets.items()))
+        rate, burst = self._limits(key)
+        if now - bucket.updated < burst / rate:
+            return False
+        del self._buckets[key]
+        return True
+
+    def _refill(self, key, now: float) -> Optional[TokenBucket]:
+        rate, burst = self._limits(key)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS and not self._evict_idle(now):
+                return None
+            bucket = self._buckets[key] = TokenBucket(burst, now)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        return bucket
+
+    def allow(self, user_id: int, chat_id: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            user_bucket = self._refill(("user", user_id), now)
+            chat_bucket = self._refill(("chat", chat_id), now)
+            if user_bucket is None or chat_bucket is None:
+                # Too many active callers to track, reject new ones until buckets are idle
+                self.metrics.incr("commands.throttle_overflow")
+                return False
+
+            # Token is taken only if both buckets allow the call
+            if user_bucket.tokens < 1 or chat_bucket.tokens < 1:
+                return False
+            user_bucket.tokens -= 1
+            chat_bucket.tokens -= 1
+            return True
 
 
 class Command(ABC):
@@ -18,6 +106,7 @@ class Command(ABC):
         self.tgb.commands.append(self)
         self.bot: TeleBot = telegram_bot.bot
         self.db: Database = telegram_bot.db
+        self.throttle = Throttle(self.get_throttle_policy(), telegram_bot.metrics)
 
     # Name of action
     @abstractmethod
@@ -29,6 +118,10 @@ class Command(ABC):
     def get_cmds(self) -> List[str]:
         pass
 
+    # Limits of calls of the action wrapped with Command.throttled
+    def get_throttle_policy(self) -> ThrottlePolicy:
+        return ThrottlePolicy()
+
     def get_callback_start(self) -> Optional[str]:
         return None
 
@@ -44,6 +137,11 @@ class Command(ABC):
     def call(self, message: Message):
         pass
 
+    # Check if the author of the message can change settings of the chat
+    def is_chat_admin(self, message: Message) -> bool:
+        member = self.bot.get_chat_member(message.chat.id, message.from_user.id)
+        return member.status in ("creator", "administrator")
+
     # Execute logic after the action is loaded
     def after_loaded(self):
         pass
@@ -94,6 +192,18 @@ class Command(ABC):
 
         return _save_data
 
+    @classmethod
+    def throttled(cls, func):
+        def _throttled(self: Command, message: Message):
+            if not self.throttle.allow(message.from_user.id, message.chat.id):
+                # Silently ignore calls over the limit
+                self.tgb.metrics.incr("commands.throttled")
+                return
+
+            return func(self, message)
+
+        return _throttled
+
     @classmethod
     def only_master(cls, func):
         def _only_master(self, message: Message):
@@ -0,0 +1,32 @@
+from typing import List, Optional
+
+from telebot.types import Message
+
+from wholeftbot import emoji
+from wholeftbot.commands import Command
+
+
+class Backup(Command):
+    def get_name(self) -> str:
+        return "Backup database"
+
+    def get_cmds(self) -> List[str]:
+        return ["backup"]
+
+    def get_description(self) -> Optional[str]:
+        return None
+
+    @Command.only_master
+    def call(self, message: Message):
+        if not self.tgb.backups:
+            self.bot.reply_to(message, emoji.WARNING + " Backups are disabled")
+            return
+
+        def _done(path, error):
+            if error:
+                self.bot.reply_to(message, f"{emoji.ERROR} Backup failed: {error}")
+            else:
+                self.bot.reply_to(message, f"{emoji.CHECK} Backup saved to {path}")
+
+        self.tgb.backups.trigger(_done)
+        self.bot.reply_to(message, emoji.WAIT + " Backup started")
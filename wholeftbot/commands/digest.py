@@ -0,0 +1,55 @@
+from typing import List, Optional
+
+from telebot.types import Message
+
+from wholeftbot import emoji
+from wholeftbot.commands import SETTINGS_THROTTLE_POLICY, Command, ThrottlePolicy
+
+
+class Digest(Command):
+    def get_name(self) -> str:
+        return "Ежедневная сводка"
+
+    def get_cmds(self) -> List[str]:
+        return ["digest"]
+
+    def get_throttle_policy(self) -> ThrottlePolicy:
+        return SETTINGS_THROTTLE_POLICY
+
+    def get_description(self) -> Optional[str]:
+        return "Ежедневная сводка о вышедших (on/off)"
+
+    @Command.throttled
+    @Command.save_data
+    @Command.send_typing
+    def call(self, message: Message):
+        if message.chat.type == "private":
+            return
+
+        args = message.text.lower().split()[1:]
+        if not args or args[0] not in ("on", "off"):
+            if self.db.is_digest_enabled(message.chat.id):
+                text = (
+                    emoji.NOTIFY
+                    + " Ежедневная сводка включена, /digest off чтобы выключить"
+                )
+            else:
+                text = (
+                    emoji.NOTIFY
+                    + " Ежедневная сводка выключена, /digest on чтобы включить"
+                )
+            self.bot.reply_to(message, text)
+            return
+
+        if not self.is_chat_admin(message):
+            self.bot.reply_to(
+                message, emoji.NO_ENTRY + " Только администраторы чата могут это менять"
+            )
+            return
+
+        enabled = args[0] == "on"
+        self.db.set_digest(message.chat.id, enabled)
+        if enabled:
+            self.bot.reply_to(message, emoji.CHECK + " Ежедневная сводка включена")
+        else:
+            self.bot.reply_to(message, emoji.CANCEL + " Ежедневная сводка выключена")
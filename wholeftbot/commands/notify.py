@@ -0,0 +1,69 @@
+from typing import List, Optional
+
+from telebot.types import Message
+
+from wholeftbot import emoji
+from wholeftbot.commands import SETTINGS_THROTTLE_POLICY, Command, ThrottlePolicy
+
+
+class Notify(Command):
+    DEFAULT_WINDOW = 60
+    MIN_WINDOW = 10
+    MAX_WINDOW = 60 * 60
+
+    def get_name(self) -> str:
+        return "Уведомления о вышедших"
+
+    def get_cmds(self) -> List[str]:
+        return ["notify"]
+
+    def get_throttle_policy(self) -> ThrottlePolicy:
+        return SETTINGS_THROTTLE_POLICY
+
+    def get_description(self) -> Optional[str]:
+        return "Уведомления о вышедших (on [секунды]/off)"
+
+    @Command.throttled
+    @Command.save_data
+    @Command.send_typing
+    def call(self, message: Message):
+        if message.chat.type == "private":
+            return
+
+        args = message.text.lower().split()[1:]
+        if not args or args[0] not in ("on", "off"):
+            window = self.tgb.notifier.get_window(message.chat.id)
+            if window:
+                text = (
+                    f"{emoji.NOTIFY} Уведомления о вышедших включены, "
+                    f"собираю их за {window} сек., /notify off чтобы выключить"
+                )
+            else:
+                text = (
+                    f"{emoji.NOTIFY} Уведомления о вышедших выключены, "
+                    f"/notify on [секунды] чтобы включить"
+                )
+            self.bot.reply_to(message, text)
+            return
+
+        if not self.is_chat_admin(message):
+            self.bot.reply_to(
+                message, emoji.NO_ENTRY + " Только администраторы чата могут это менять"
+            )
+            return
+
+        if args[0] == "off":
+            self.tgb.notifier.set_window(message.chat.id, None)
+            self.bot.reply_to(
+                message, emoji.CANCEL + " Уведомления о вышедших выключены"
+            )
+            return
+
+        window = self.DEFAULT_WINDOW
+        if len(args) > 1 and args[1].isdigit():
+            window = min(max(int(args[1]), self.MIN_WINDOW), self.MAX_WINDOW)
+        self.tgb.notifier.set_window(message.chat.id, window)
+        self.bot.reply_to(
+            message,
+            f"{emoji.CHECK} Уведомления о вышедших включены, собираю их за {window} сек.",
+        )
@@ -0,0 +1,35 @@
+from typing import List, Optional
+
+from telebot.types import Message
+
+from wholeftbot import emoji
+from wholeftbot.commands import Command
+
+
+class Stats(Command):
+    def get_name(self) -> str:
+        return "Stats"
+
+    def get_cmds(self) -> List[str]:
+        return ["stats"]
+
+    def get_description(self) -> Optional[str]:
+        return None
+
+    @Command.only_master
+    def call(self, message: Message):
+        counters = self.tgb.metrics.snapshot()
+        text = emoji.INFO + " Stats:\n"
+        for name in sorted(counters):
+            text += f"{name}: {counters[name]}\n"
+
+        timings = self.tgb.metrics.timings()
+        timings.update(self.db.metrics.timings())
+        for name in sorted(timings):
+            t = timings[name]
+            text += (
+                f"{name}: n={t['count']} avg={t['avg'] * 1000:.1f}ms "
+                f"p99={t['p99'] * 1000:.1f}ms max={t['max'] * 1000:.1f}ms\n"
+            )
+
+        self.bot.reply_to(message, text)
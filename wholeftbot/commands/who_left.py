@@ -7,6 +7,9 @@ from wholeftbot.commands import Command
 
 
 class WhoLeft(Command):
+    # Argument to show only users who haven't returned to the chat
+    ARG_GONE = "gone"
+
     def get_name(self) -> str:
         return "Кто покинул чат?"
 
@@ -16,20 +19,25 @@ class WhoLeft(Command):
     def get_description(self) -> Optional[str]:
         return "Кто покинул чат?"
 
+    @Command.throttled
     @Command.save_data
     @Command.send_typing
     def call(self, message: Message):
         if message.chat.type == "private":
             return
 
-        users = self.db.get_left_members(message.chat.id, "-1 day")
+        exclude_rejoined = self.ARG_GONE in message.text.lower().split()[1:]
+        users = self.db.get_left_members(message.chat.id, "-1 day", exclude_rejoined)
         if len(users) == 0:
             self.bot.reply_to(
                 message, "За последние сутки никто из чата не выходил! " + emoji.HEART
             )
             return
 
-        text = emoji.SAD + "За последние сутки из чата вышли:\n"
+        if exclude_rejoined:
+            text = emoji.SAD + "За последние сутки из чата вышли и не вернулись:\n"
+        else:
+            text = emoji.SAD + "За последние сутки из чата вышли:\n"
         for user in users:
             text += utils.user_name(user, mention=True) + "\n"
 
@@ -1,9 +1,17 @@
+import copy
 import os
+import pathlib
+import queue
 import sqlite3
-from typing import Optional, Set, List
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set, List
 
 from telebot.types import User as TelegramUser, Chat as TelegramChat
 
+from wholeftbot.metrics import Metrics
+
 
 class User:
     def __init__(self, row):
@@ -28,6 +36,45 @@ class Chat:
         ) = row
 
 
+class _ReadersPool:
+    """
+    Read-only connections, shared by tenant views of the database
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.count = 0
+        self.lock = threading.Lock()
+        self.connections: queue.LifoQueue = queue.LifoQueue()
+
+    def acquire(self, connect) -> sqlite3.Connection:
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.count < self.size:
+                self.count += 1
+                return connect()
+
+        return self.connections.get()
+
+    def release(self, con: sqlite3.Connection):
+        self.connections.put(con)
+
+
+class _Writer:
+    """
+    Connection for all writes, shared by tenant views of the database
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.con: Optional[sqlite3.Connection] = None
+        self.depth = 0
+
+
 class Database:
     SQL_DB_EXISTS = "SELECT name FROM sqlite_master"
     SQL_CREATE_USERS = """CREATE TABLE users (
@@ -49,6 +96,7 @@ class Database:
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP
     )"""
     SQL_CREATE_CMD_DATA = """CREATE TABLE cmd_data (
+        tenant_id INTEGER NOT NULL DEFAULT 0,
         user_id INTEGER NOT NULL,
         chat_id INTEGER,
         command TEXT NOT NULL,
@@ -57,12 +105,81 @@ class Database:
         FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
     )"""
     SQL_CREATE_LEFT_MEMBER_LOG = """CREATE TABLE left_member_log (
+        tenant_id INTEGER NOT NULL DEFAULT 0,
         user_id INTEGER NOT NULL,
         chat_id INTEGER NOT NULL ,
         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
         FOREIGN KEY(user_id) REFERENCES users(user_id),
         FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
     )"""
+    SQL_CREATE_JOIN_MEMBER_LOG = """CREATE TABLE join_member_log (
+        tenant_id INTEGER NOT NULL DEFAULT 0,
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(user_id),
+        FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+    )"""
+    # joined_at or left_at is NULL if the event wasn't seen by the bot
+    SQL_CREATE_MEMBERSHIP_INTERVALS = """CREATE TABLE membership_intervals (
+        tenant_id INTEGER NOT NULL DEFAULT 0,
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        joined_at DATETIME,
+        left_at DATETIME,
+        FOREIGN KEY(user_id) REFERENCES users(user_id),
+        FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+    )"""
+    SQL_CREATE_DIGEST_SUBSCRIPTIONS = """CREATE TABLE digest_subscriptions (
+        tenant_id INTEGER NOT NULL DEFAULT 0,
+        chat_id INTEGER NOT NULL,
+        next_delivery_at DATETIME NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(tenant_id, chat_id),
+        FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+    )"""
+    SQL_CREATE_LEAVE_NOTIFICATIONS = """CREATE TABLE leave_notifications (
+        tenant_id INTEGER NOT NULL DEFAULT 0,
+        chat_id INTEGER NOT NULL,
+        debounce_seconds INTEGER NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY(tenant_id, chat_id),
+        FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+    )"""
+    SQL_CREATE_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS membership_intervals_tenant_member "
+        "ON membership_intervals (tenant_id, chat_id, user_id, left_at)",
+        "CREATE INDEX IF NOT EXISTS membership_intervals_tenant_left "
+        "ON membership_intervals (tenant_id, chat_id, left_at)",
+        "CREATE INDEX IF NOT EXISTS membership_intervals_tenant_joined "
+        "ON membership_intervals (tenant_id, chat_id, joined_at)",
+        "CREATE INDEX IF NOT EXISTS left_member_log_tenant_chat "
+        "ON left_member_log (tenant_id, chat_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS digest_subscriptions_tenant_delivery "
+        "ON digest_subscriptions (tenant_id, next_delivery_at)",
+    )
+    # Indexes created before tables were partitioned by tenant
+    SQL_DROP_OBSOLETE_INDEXES = (
+        "DROP INDEX IF EXISTS membership_intervals_member",
+        "DROP INDEX IF EXISTS membership_intervals_left",
+        "DROP INDEX IF EXISTS membership_intervals_joined",
+        "DROP INDEX IF EXISTS left_member_log_chat",
+        "DROP INDEX IF EXISTS digest_subscriptions_delivery",
+    )
+    SQL_MEMBERSHIP_INTERVALS_BACKFILL = """INSERT INTO membership_intervals (tenant_id, chat_id, user_id, left_at)
+        SELECT tenant_id, chat_id, user_id, created_at FROM left_member_log ORDER BY rowid
+    """
+    SQL_TABLE_COLUMNS = "SELECT name FROM pragma_table_info(?)"
+    SQL_ADD_TENANT_COLUMN = (
+        "ALTER TABLE {} ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT 0"
+    )
+    SQL_DIGEST_SUBSCRIPTIONS_MIGRATE = (
+        "ALTER TABLE digest_subscriptions RENAME TO digest_subscriptions_old",
+        SQL_CREATE_DIGEST_SUBSCRIPTIONS,
+        "INSERT INTO digest_subscriptions (chat_id, next_delivery_at, created_at) "
+        "SELECT chat_id, next_delivery_at, created_at FROM digest_subscriptions_old",
+        "DROP TABLE digest_subscriptions_old",
+    )
 
     SQL_USER_EXISTS = """SELECT EXISTS (
         SELECT 1 FROM users WHERE user_id = ?
@@ -70,6 +187,13 @@ class Database:
     SQL_USER_ADD = "INSERT INTO users (user_id, first_name, last_name, username, language) VALUES (?, ?, ?, ?, ?)"
     SQL_USER_DELETE = "DELETE FROM users WHERE user_id = ?"
     SQL_USER_UPDATE = "UPDATE users SET first_name = ?, last_name = ?, username = ?, language = ? WHERE user_id = ?"
+    SQL_USERS_UPSERT = """INSERT INTO users (user_id, first_name, last_name, username, language) VALUES {}
+        ON CONFLICT(user_id) DO UPDATE SET first_name = excluded.first_name, last_name = excluded.last_name,
+        username = excluded.username, language = excluded.language
+    """
+    SQL_USERS_DELETE_BY_UN = (
+        "DELETE FROM users WHERE lower(username) IN ({}) AND user_id NOT IN ({})"
+    )
     SQL_USER_GET = (
         "SELECT user_id, first_name, last_name, username, language, created_at "
         "FROM users WHERE user_id = ?"
@@ -92,28 +216,166 @@ class Database:
     SQL_CHAT_UPDATE = (
         "UPDATE chats SET type = ?, title = ?, username = ? WHERE chat_id = ?"
     )
+    SQL_CHAT_UPSERT = """INSERT INTO chats (chat_id, type, title, username) VALUES (?, ?, ?, ?)
+        ON CONFLICT(chat_id) DO UPDATE SET type = excluded.type, title = excluded.title, username = excluded.username
+    """
     SQL_CHAT_GET = (
         "SELECT chat_id, type, title, username, created_at FROM chats WHERE chat_id = ?"
     )
 
-    SQL_CMD_ADD = "INSERT INTO cmd_data (user_id, chat_id, command) VALUES (?, ?, ?)"
-    SQL_MEMBER_LEFT_ADD = "INSERT INTO left_member_log (user_id, chat_id) VALUES (?, ?)"
+    SQL_CMD_ADD = "INSERT INTO cmd_data (tenant_id, user_id, chat_id, command) VALUES (?, ?, ?, ?)"
+    SQL_MEMBER_LEFT_ADD = (
+        "INSERT INTO left_member_log (tenant_id, user_id, chat_id) VALUES (?, ?, ?)"
+    )
     SQL_MEMBER_LEFT_GET = """SELECT u.user_id, first_name, last_name, username, language, left_member_log.created_at 
         FROM left_member_log LEFT JOIN users u on left_member_log.user_id = u.user_id 
-        WHERE chat_id = ? AND left_member_log.created_at BETWEEN datetime('now', ?) AND datetime('now', 'localtime')
+        WHERE tenant_id = ? AND chat_id = ? AND left_member_log.created_at BETWEEN datetime('now', ?) AND datetime('now', 'localtime')
         GROUP BY u.user_id;
     """
+    SQL_MEMBERS_LEFT_GROUPED_GET = """SELECT l.chat_id, u.user_id, first_name, last_name, username, language, l.created_at
+        FROM left_member_log l LEFT JOIN users u on l.user_id = u.user_id
+        WHERE l.tenant_id = ? AND l.chat_id IN ({}) AND l.created_at BETWEEN datetime('now', ?) AND datetime('now', 'localtime')
+        GROUP BY l.chat_id, u.user_id
+        ORDER BY l.chat_id;
+    """
+    SQL_MEMBER_JOIN_ADD = (
+        "INSERT INTO join_member_log (tenant_id, user_id, chat_id) VALUES {}"
+    )
+    SQL_INTERVAL_OPEN = """INSERT INTO membership_intervals (tenant_id, chat_id, user_id, joined_at)
+        SELECT ?, ?, v.column1, CURRENT_TIMESTAMP FROM (VALUES {}) v
+        WHERE NOT EXISTS (
+            SELECT 1 FROM membership_intervals m
+            WHERE m.tenant_id = ? AND m.chat_id = ? AND m.user_id = v.column1 AND m.left_at IS NULL
+        )
+    """
+    SQL_INTERVAL_CLOSE = """UPDATE membership_intervals SET left_at = CURRENT_TIMESTAMP
+        WHERE tenant_id = ? AND chat_id = ? AND user_id = ? AND left_at IS NULL
+    """
+    SQL_INTERVAL_LEFT_ADD = """INSERT INTO membership_intervals (tenant_id, chat_id, user_id, left_at)
+        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    """
+    SQL_MEMBER_GONE_GET = """SELECT u.user_id, first_name, last_name, username, language, m.left_at
+        FROM membership_intervals m LEFT JOIN users u on m.user_id = u.user_id
+        WHERE m.tenant_id = ? AND m.chat_id = ?
+        AND m.left_at BETWEEN datetime('now', ?) AND datetime('now', 'localtime')
+        AND NOT EXISTS (
+            SELECT 1 FROM membership_intervals r
+            WHERE r.tenant_id = m.tenant_id AND r.chat_id = m.chat_id AND r.user_id = m.user_id AND r.left_at IS NULL
+        )
+        GROUP BY u.user_id;
+    """
+    SQL_MEMBERS_AT_GET = """SELECT DISTINCT u.user_id, first_name, last_name, username, language, u.created_at
+        FROM membership_intervals m JOIN users u on m.user_id = u.user_id
+        WHERE m.tenant_id = ? AND m.chat_id = ? AND (m.joined_at IS NULL OR m.joined_at <= datetime(?))
+        AND (m.left_at IS NULL OR m.left_at > datetime(?))
+    """
+
+    SQL_DIGEST_ADD = (
+        "INSERT OR IGNORE INTO digest_subscriptions (tenant_id, chat_id, next_delivery_at) "
+        "VALUES (?, ?, datetime('now', '+1 day'))"
+    )
+    SQL_DIGEST_DELETE = (
+        "DELETE FROM digest_subscriptions WHERE tenant_id = ? AND chat_id = ?"
+    )
+    SQL_DIGEST_EXISTS = """SELECT EXISTS (
+        SELECT 1 FROM digest_subscriptions WHERE tenant_id = ? AND chat_id = ?
+    )"""
+    SQL_DIGEST_DUE_GET = """SELECT chat_id FROM digest_subscriptions
+        WHERE tenant_id = ? AND next_delivery_at <= CURRENT_TIMESTAMP
+        ORDER BY next_delivery_at LIMIT ?
+    """
+    # Next delivery is never in the past, even if the bot was down for days
+    SQL_DIGEST_ADVANCE = """UPDATE digest_subscriptions SET next_delivery_at = CASE
+            WHEN datetime(next_delivery_at, '+1 day') > CURRENT_TIMESTAMP
+            THEN datetime(next_delivery_at, '+1 day')
+            ELSE datetime('now', '+1 day')
+        END
+        WHERE tenant_id = ? AND chat_id IN ({})
+    """
+
+    SQL_NOTIFICATIONS_SET = (
+        "INSERT OR REPLACE INTO leave_notifications (tenant_id, chat_id, debounce_seconds) "
+        "VALUES (?, ?, ?)"
+    )
+    SQL_NOTIFICATIONS_DELETE = (
+        "DELETE FROM leave_notifications WHERE tenant_id = ? AND chat_id = ?"
+    )
+    SQL_NOTIFICATIONS_GET = (
+        "SELECT chat_id, debounce_seconds FROM leave_notifications WHERE tenant_id = ?"
+    )
 
-    def __init__(self, db_path):
+    SQL_EXPORT = {
+        "left_members": """SELECT t.tenant_id, t.created_at, t.chat_id, c.type, c.title, c.username,
+            t.user_id, u.first_name, u.last_name, u.username, u.language
+        FROM left_member_log t
+        LEFT JOIN users u ON t.user_id = u.user_id
+        LEFT JOIN chats c ON t.chat_id = c.chat_id""",
+        "commands": """SELECT t.tenant_id, t.created_at, t.chat_id, t.user_id, u.username, t.command
+        FROM cmd_data t
+        LEFT JOIN users u ON t.user_id = u.user_id""",
+    }
+    EXPORT_COLUMNS = {
+        "left_members": (
+            "tenant_id",
+            "created_at",
+            "chat_id",
+            "chat_type",
+            "chat_title",
+            "chat_username",
+            "user_id",
+            "first_name",
+            "last_name",
+            "username",
+            "language",
+        ),
+        "commands": (
+            "tenant_id",
+            "created_at",
+            "chat_id",
+            "user_id",
+            "username",
+            "command",
+        ),
+    }
+
+    READ_POOL_SIZE = 4
+    BUSY_TIMEOUT = 10.0
+
+    def __init__(self, db_path, metrics: Optional[Metrics] = None, readonly=False):
         self._db_path = db_path
+        self.metrics: Metrics = metrics or Metrics()
+        # Logs of different bots sharing the database are partitioned by tenant
+        self.tenant_id: int = 0
+
+        self._readers = _ReadersPool(self.READ_POOL_SIZE)
+        self._writer = _Writer()
 
+        if not readonly:
+            self._create_tables()
+
+    def for_tenant(self, tenant_id: int) -> "Database":
+        """
+        View of the database for another tenant, sharing connections with this one,
+        timings of its queries are recorded by its own metrics
+        :param tenant_id: tenant id
+        :return:
+        """
+        db = copy.copy(self)
+        db.tenant_id = tenant_id
+        db.metrics = Metrics()
+        return db
+
+    def _create_tables(self):
         # Create 'data' directory if not present
-        data_dir = os.path.dirname(db_path)
+        data_dir = os.path.dirname(self._db_path)
         os.makedirs(data_dir, exist_ok=True)
 
-        con = sqlite3.connect(db_path)
+        con = sqlite3.connect(self._db_path)
         cur = con.cursor()
 
+        # WAL lets readers work on a snapshot while the writer commits
+        cur.execute("PRAGMA journal_mode=WAL")
+
         # If tables don't exist, create them
         tables = set([row[0] for row in cur.execute(self.SQL_DB_EXISTS).fetchall()])
         if "users" not in tables:
@@ -125,10 +387,193 @@ class Database:
             cur.execute(self.SQL_CREATE_CMD_DATA)
         if "left_member_log" not in tables:
             cur.execute(self.SQL_CREATE_LEFT_MEMBER_LOG)
+        if "join_member_log" not in tables:
+            cur.execute(self.SQL_CREATE_JOIN_MEMBER_LOG)
+
+        # Tables created before logs were partitioned by tenant belong to tenant 0
+        for table in ("cmd_data", "left_member_log", "join_member_log"):
+            self._add_tenant_column(cur, table)
+        if "membership_intervals" in tables:
+            self._add_tenant_column(cur, "membership_intervals")
+        if "digest_subscriptions" in tables and not self._has_tenant_column(
+            cur, "digest_subscriptions"
+        ):
+            # Primary key changes, so the table has to be rebuilt
+            for sql in self.SQL_DIGEST_SUBSCRIPTIONS_MIGRATE:
+                cur.execute(sql)
+
+        if "membership_intervals" not in tables:
+            cur.execute(self.SQL_CREATE_MEMBERSHIP_INTERVALS)
+            cur.execute(self.SQL_MEMBERSHIP_INTERVALS_BACKFILL)
+        if "digest_subscriptions" not in tables:
+            cur.execute(self.SQL_CREATE_DIGEST_SUBSCRIPTIONS)
+        if "leave_notifications" not in tables:
+            cur.execute(self.SQL_CREATE_LEAVE_NOTIFICATIONS)
+
+        for sql in self.SQL_DROP_OBSOLETE_INDEXES + self.SQL_CREATE_INDEXES:
+            cur.execute(sql)
         con.commit()
 
         con.close()
 
+    def _has_tenant_column(self, cur: sqlite3.Cursor, table: str) -> bool:
+        columns = [row[0] for row in cur.execute(self.SQL_TABLE_COLUMNS, (table,))]
+        return "tenant_id" in columns
+
+    def _add_tenant_column(self, cur: sqlite3.Cursor, table: str):
+        if not self._has_tenant_column(cur, table):
+            cur.execute(self.SQL_ADD_TENANT_COLUMN.format(table))
+
+    def _connect_readonly(self) -> sqlite3.Connection:
+        uri = pathlib.Path(self._db_path).resolve().as_uri() + "?mode=ro"
+        con = sqlite3.connect(
+            uri,
+            uri=True,
+            timeout=self.BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        con.execute("PRAGMA query_only=1")
+        return con
+
+    @contextmanager
+    def reader(self):
+        """
+        Cursor of a pooled read-only connection
+        :return:
+        """
+        started = time.monotonic()
+        con = self._readers.acquire(self._connect_readonly)
+        acquired = time.monotonic()
+        self.metrics.observe("db.read.wait", acquired - started)
+        try:
+            yield con.cursor()
+        finally:
+            self.metrics.observe("db.read", time.monotonic() - acquired)
+            self._readers.release(con)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Cursor of the writer connection, nested transactions are committed by the outermost one
+        and are savepoints, so a failed nested transaction is rolled back alone
+        :return:
+        """
+        writer = self._writer
+        started = time.monotonic()
+        with writer.lock:
+            acquired = time.monotonic()
+            if writer.con is None:
+                writer.con = sqlite3.connect(
+                    self._db_path, timeout=self.BUSY_TIMEOUT, check_same_thread=False
+                )
+
+            writer.depth += 1
+            savepoint = None
+            try:
+                if writer.depth > 1:
+                    # Savepoint outside of a transaction would be committed on release
+                    if not writer.con.in_transaction:
+                        writer.con.execute("BEGIN")
+                    savepoint = f"nested_{writer.depth}"
+                    writer.con.execute(f"SAVEPOINT {savepoint}")
+
+                yield writer.con.cursor()
+                if savepoint:
+                    writer.con.execute(f"RELEASE {savepoint}")
+                else:
+                    writer.con.commit()
+            except Exception:
+                if savepoint:
+                    writer.con.execute(f"ROLLBACK TO {savepoint}")
+                    writer.con.execute(f"RELEASE {savepoint}")
+                else:
+                    writer.con.rollback()
+                raise
+            finally:
+                writer.depth -= 1
+                if writer.depth == 0:
+                    self.metrics.observe("db.write.wait", acquired - started)
+                    self.metrics.observe("db.write", time.monotonic() - acquired)
+
+    def backup(self, target_path: str, pages: int, step_sleep: float):
+        """
+        Copy database to the target file with SQLite online backup API
+        :param target_path: path of the snapshot file
+        :param pages: number of pages copied per step
+        :param step_sleep: pause between steps, so writers are not stalled
+        :return:
+        """
+        with self.metrics.timer("db.backup"):
+            src = self._connect_readonly()
+            dst = sqlite3.connect(target_path)
+            try:
+                # Hold a read snapshot, otherwise commits from other connections
+                # make the backup restart from the first page
+                src.execute("BEGIN")
+                src.execute(self.SQL_DB_EXISTS).fetchall()
+                src.backup(
+                    dst,
+                    pages=pages,
+                    progress=lambda status, remaining, total: time.sleep(step_sleep),
+                )
+                src.execute("COMMIT")
+            finally:
+                dst.close()
+                src.close()
+
+    def export_rows(
+        self,
+        table: str,
+        tenant_ids: Optional[List[int]] = None,
+        chat_ids: Optional[List[int]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        chunk_size=1000,
+    ) -> Iterator[tuple]:
+        """
+        Stream rows of the log table from a single snapshot, see EXPORT_COLUMNS
+        :param table: "left_members" or "commands"
+        :param tenant_ids: export only these tenants
+        :param chat_ids: export only these chats
+        :param since: export rows created at or after this datetime
+        :param until: export rows created before this datetime
+        :param chunk_size: number of rows fetched at once
+        :return:
+        """
+        conditions, params = [], []
+        if tenant_ids:
+            conditions.append(f"t.tenant_id IN ({','.join('?' * len(tenant_ids))})")
+            params.extend(tenant_ids)
+        if chat_ids:
+            conditions.append(f"t.chat_id IN ({','.join('?' * len(chat_ids))})")
+            params.extend(chat_ids)
+        if since:
+            conditions.append("t.created_at >= datetime(?)")
+            params.append(since)
+        if until:
+            conditions.append("t.created_at < datetime(?)")
+            params.append(until)
+
+        sql = self.SQL_EXPORT[table]
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY t.rowid"
+
+        # Dedicated connection, so a long export doesn't hold a pooled one
+        con = self._connect_readonly()
+        try:
+            con.execute("BEGIN")
+            cur = con.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+            con.execute("COMMIT")
+        finally:
+            con.close()
+
     def save_user_and_chat(self, user: TelegramUser, chat: Optional[TelegramChat]):
         """
         Save user and / or chat to database
@@ -136,128 +581,251 @@ class Database:
         :param chat: Chat
         :return:
         """
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-
-        # Check if user already exists
-        cur.execute(self.SQL_USER_EXISTS, [user.id])
-        # Add user if he doesn't exist
-        if cur.fetchone()[0] != 1:
-            # Hack to avoid duplicated usernames bag
-            user_with_same_username = self.get_user_by_username(user.username)
-            if user_with_same_username is not None:
-                cur.execute(self.SQL_USER_DELETE, [user_with_same_username.id])
-                con.commit()
-            cur.execute(
-                self.SQL_USER_ADD,
-                (
-                    user.id,
-                    user.first_name,
-                    user.last_name,
-                    user.username,
-                    user.language_code,
-                ),
-            )
-            con.commit()
-        else:
-            cur.execute(
-                self.SQL_USER_UPDATE,
-                (
-                    user.first_name,
-                    user.last_name,
-                    user.username,
-                    user.language_code,
-                    user.id,
-                ),
-            )
-            con.commit()
-
-        chat_id = None
-
-        if chat and chat.id != user.id:
-            chat_id = chat.id
-
-            # Check if chat already exists
-            cur.execute(self.SQL_CHAT_EXISTS, (chat.id,))
-
-            con.commit()
-
-            # Add chat if it doesn't exist
+        with self.transaction() as cur:
+            # Check if user already exists
+            cur.execute(self.SQL_USER_EXISTS, [user.id])
+            # Add user if he doesn't exist
             if cur.fetchone()[0] != 1:
+                # Hack to avoid duplicated usernames bag
+                cur.execute(self.SQL_USER_GET_BY_UN, (user.username,))
+                user_with_same_username = cur.fetchone()
+                if user_with_same_username is not None:
+                    cur.execute(self.SQL_USER_DELETE, [user_with_same_username[0]])
                 cur.execute(
-                    self.SQL_CHAT_ADD, (chat.id, chat.type, chat.title, chat.username)
+                    self.SQL_USER_ADD,
+                    (
+                        user.id,
+                        user.first_name,
+                        user.last_name,
+                        user.username,
+                        user.language_code,
+                    ),
                 )
-                con.commit()
             else:
                 cur.execute(
-                    self.SQL_CHAT_UPDATE,
-                    (chat.type, chat.title, chat.username, chat.id),
+                    self.SQL_USER_UPDATE,
+                    (
+                        user.first_name,
+                        user.last_name,
+                        user.username,
+                        user.language_code,
+                        user.id,
+                    ),
                 )
-                con.commit()
 
-        con.close()
+            chat_id = None
+
+            if chat and chat.id != user.id:
+                chat_id = chat.id
+
+                # Check if chat already exists
+                cur.execute(self.SQL_CHAT_EXISTS, (chat.id,))
+
+                # Add chat if it doesn't exist
+                if cur.fetchone()[0] != 1:
+                    cur.execute(
+                        self.SQL_CHAT_ADD,
+                        (chat.id, chat.type, chat.title, chat.username),
+                    )
+                else:
+                    cur.execute(
+                        self.SQL_CHAT_UPDATE,
+                        (chat.type, chat.title, chat.username, chat.id),
+                    )
 
         return user.id, chat_id
 
     def save_cmd(self, user, chat, cmd):
-        user_id, chat_id = self.save_user_and_chat(user, chat)
+        with self.transaction() as cur:
+            user_id, chat_id = self.save_user_and_chat(user, chat)
 
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
+            # Save issued command
+            cur.execute(self.SQL_CMD_ADD, (self.tenant_id, user_id, chat_id, cmd))
 
-        # Save issued command
-        cur.execute(self.SQL_CMD_ADD, (user_id, chat_id, cmd))
+    def left_member_log(self, user, chat):
+        with self.transaction() as cur:
+            user_id, chat_id = self.save_user_and_chat(user, chat)
 
-        con.commit()
-        con.close()
+            cur.execute(self.SQL_MEMBER_LEFT_ADD, (self.tenant_id, user_id, chat_id))
 
-    def left_member_log(self, user, chat):
-        user_id, chat_id = self.save_user_and_chat(user, chat)
+            cur.execute(self.SQL_INTERVAL_CLOSE, (self.tenant_id, chat_id, user_id))
+            if cur.rowcount == 0:
+                # Join wasn't seen, record interval with unknown start
+                cur.execute(
+                    self.SQL_INTERVAL_LEFT_ADD, (self.tenant_id, chat_id, user_id)
+                )
 
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
+    def join_members_log(self, users: List[TelegramUser], chat):
+        """
+        Save members joined with a single service message
+        :param users: new chat members
+        :param chat: Chat
+        :return:
+        """
+        with self.transaction() as cur:
+            users_ids = [user.id for user in users]
+            cur.execute(
+                self.SQL_CHAT_UPSERT, (chat.id, chat.type, chat.title, chat.username)
+            )
 
-        cur.execute(self.SQL_MEMBER_LEFT_ADD, (user_id, chat_id))
+            # Hack to avoid duplicated usernames bag, for all users at once
+            usernames = [user.username.lower() for user in users if user.username]
+            if usernames:
+                cur.execute(
+                    self.SQL_USERS_DELETE_BY_UN.format(
+                        ",".join("?" * len(usernames)), ",".join("?" * len(users_ids))
+                    ),
+                    (*usernames, *users_ids),
+                )
+            cur.execute(
+                self.SQL_USERS_UPSERT.format(
+                    ",".join(["(?, ?, ?, ?, ?)"] * len(users))
+                ),
+                [
+                    value
+                    for user in users
+                    for value in (
+                        user.id,
+                        user.first_name,
+                        user.last_name,
+                        user.username,
+                        user.language_code,
+                    )
+                ],
+            )
 
-        con.commit()
-        con.close()
+            cur.execute(
+                self.SQL_MEMBER_JOIN_ADD.format(
+                    ",".join(["(?, ?, ?)"] * len(users_ids))
+                ),
+                [
+                    value
+                    for user_id in users_ids
+                    for value in (self.tenant_id, user_id, chat.id)
+                ],
+            )
+            cur.execute(
+                self.SQL_INTERVAL_OPEN.format(",".join(["(?)"] * len(users_ids))),
+                (self.tenant_id, chat.id, *users_ids, self.tenant_id, chat.id),
+            )
+
+    def set_digest(self, chat_id: int, enabled: bool):
+        with self.transaction() as cur:
+            if enabled:
+                cur.execute(self.SQL_DIGEST_ADD, (self.tenant_id, chat_id))
+            else:
+                cur.execute(self.SQL_DIGEST_DELETE, (self.tenant_id, chat_id))
+
+    def advance_digests(self, chat_ids: List[int]):
+        """
+        Schedule next delivery of the digests
+        :param chat_ids: chats which digests were delivered
+        :return:
+        """
+        with self.transaction() as cur:
+            cur.execute(
+                self.SQL_DIGEST_ADVANCE.format(",".join("?" * len(chat_ids))),
+                (self.tenant_id, *chat_ids),
+            )
+
+    def set_leave_notifications(self, chat_id: int, debounce_seconds: Optional[int]):
+        """
+        Enable or disable notifications about left members
+        :param chat_id: chat id
+        :param debounce_seconds: time to collect leaves into one message, None to disable
+        :return:
+        """
+        with self.transaction() as cur:
+            if debounce_seconds:
+                cur.execute(
+                    self.SQL_NOTIFICATIONS_SET,
+                    (self.tenant_id, chat_id, debounce_seconds),
+                )
+            else:
+                cur.execute(self.SQL_NOTIFICATIONS_DELETE, (self.tenant_id, chat_id))
 
     def get_user(self, user_id: int) -> Optional[User]:
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-        cur.execute(self.SQL_USER_GET, (user_id,))
-        row = cur.fetchone()
-        con.close()
+        with self.reader() as cur:
+            cur.execute(self.SQL_USER_GET, (user_id,))
+            row = cur.fetchone()
         return User(row) if row else None
 
     def get_users(self, users_ids: Set[int]) -> List[User]:
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-        cur.execute(self.SQL_USERS_GET.format(",".join(map(str, users_ids))))
-        rows = cur.fetchall()
-        con.close()
+        with self.reader() as cur:
+            cur.execute(self.SQL_USERS_GET.format(",".join(map(str, users_ids))))
+            rows = cur.fetchall()
         return [User(row) for row in rows]
 
     def get_user_by_username(self, username: str) -> Optional[User]:
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-        cur.execute(self.SQL_USER_GET_BY_UN, (username,))
-        row = cur.fetchone()
-        con.close()
+        with self.reader() as cur:
+            cur.execute(self.SQL_USER_GET_BY_UN, (username,))
+            row = cur.fetchone()
         return User(row) if row else None
 
     def get_chat(self, chat_id: int) -> Optional[Chat]:
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-        cur.execute(self.SQL_CHAT_GET, (chat_id,))
-        row = cur.fetchone()
-        con.close()
+        with self.reader() as cur:
+            cur.execute(self.SQL_CHAT_GET, (chat_id,))
+            row = cur.fetchone()
         return Chat(row) if row else None
 
-    def get_left_members(self, chat_id: int, datetime_param: str) -> List[User]:
-        con = sqlite3.connect(self._db_path)
-        cur = con.cursor()
-        cur.execute(self.SQL_MEMBER_LEFT_GET, (chat_id, datetime_param))
-        rows = cur.fetchall()
-        con.close()
+    def get_left_members(
+        self, chat_id: int, datetime_param: str, exclude_rejoined=False
+    ) -> List[User]:
+        sql = self.SQL_MEMBER_GONE_GET if exclude_rejoined else self.SQL_MEMBER_LEFT_GET
+        with self.reader() as cur:
+            cur.execute(sql, (self.tenant_id, chat_id, datetime_param))
+            rows = cur.fetchall()
         return [User(row) for row in rows]
+
+    def get_members_at(self, chat_id: int, at: str) -> List[User]:
+        """
+        Members of the chat at the given UTC datetime, as far as joins and leaves were seen
+        :param chat_id: chat id
+        :param at: datetime string
+        :return:
+        """
+        with self.reader() as cur:
+            cur.execute(self.SQL_MEMBERS_AT_GET, (self.tenant_id, chat_id, at, at))
+            rows = cur.fetchall()
+        return [User(row) for row in rows]
+
+    def is_digest_enabled(self, chat_id: int) -> bool:
+        with self.reader() as cur:
+            cur.execute(self.SQL_DIGEST_EXISTS, (self.tenant_id, chat_id))
+            return cur.fetchone()[0] == 1
+
+    def get_due_digests(self, limit: int) -> List[int]:
+        with self.reader() as cur:
+            cur.execute(self.SQL_DIGEST_DUE_GET, (self.tenant_id, limit))
+            rows = cur.fetchall()
+        return [row[0] for row in rows]
+
+    def get_left_members_grouped(
+        self, chat_ids: List[int], datetime_param: str
+    ) -> Dict[int, List[User]]:
+        """
+        Left members of many chats with a single query
+        :param chat_ids: chats ids
+        :param datetime_param: period modifier, e.g. "-1 day"
+        :return: users by chat id
+        """
+        with self.reader() as cur:
+            cur.execute(
+                self.SQL_MEMBERS_LEFT_GROUPED_GET.format(",".join("?" * len(chat_ids))),
+                (self.tenant_id, *chat_ids, datetime_param),
+            )
+            rows = cur.fetchall()
+
+        result: Dict[int, List[User]] = {}
+        for row in rows:
+            result.setdefault(row[0], []).append(User(row[1:]))
+        return result
+
+    def get_leave_notifications(self) -> Dict[int, int]:
+        """
+        :return: debounce seconds by chat id of chats with enabled notifications
+        """
+        with self.reader() as cur:
+            cur.execute(self.SQL_NOTIFICATIONS_GET, (self.tenant_id,))
+            rows = cur.fetchall()
+        return dict(rows)
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+from typing import List, Tuple
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+
+from wholeftbot import emoji, utils
+from wholeftbot.database import Database, User
+
+
+class DigestScheduler:
+    """
+    Sends daily "who left" digests to subscribed chats in batches
+    """
+
+    CHECK_INTERVAL = 60
+    BATCH_SIZE = 1000
+    # Bot API allows about 30 messages per second in total
+    MESSAGES_PER_SECOND = 20
+    MESSAGE_LIMIT = 4000
+    SEND_ATTEMPTS = 3
+
+    def __init__(self, bot: TeleBot, db: Database):
+        self.bot: TeleBot = bot
+        self.db: Database = db
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="digest", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as ex:  # pylint: disable=W0703
+                logging.error(f"Digest delivery failed: {ex}")
+            time.sleep(self.CHECK_INTERVAL)
+
+    def run_once(self):
+        """
+        Deliver one batch of due digests
+        :return:
+        """
+        chat_ids = self.db.get_due_digests(self.BATCH_SIZE)
+        if not chat_ids:
+            return
+
+        left_members = self.db.get_left_members_grouped(chat_ids, "-1 day")
+        messages = [
+            (chat_id, self.render(users)) for chat_id, users in left_members.items()
+        ]
+
+        # Schedule next delivery first, so a crash doesn't make us send digests twice
+        self.db.advance_digests(chat_ids)
+        self._deliver(messages)
+
+    @staticmethod
+    def render(users: List[User]) -> str:
+        text = emoji.SAD + "Итоги дня, за последние сутки из чата вышли:\n"
+        for user in users:
+            text += utils.user_name(user, mention=True) + "\n"
+        return text
+
+    def _deliver(self, messages: List[Tuple[int, str]]):
+        for chat_id, text in messages:
+            for chunk in utils.split_lines(text, self.MESSAGE_LIMIT):
+                if not self._send(chat_id, chunk):
+                    break
+                time.sleep(1 / self.MESSAGES_PER_SECOND)
+
+    def _send(self, chat_id: int, text: str) -> bool:
+        try:
+            utils.send_message_with_retry(
+                self.bot, chat_id, text, self.SEND_ATTEMPTS, parse_mode="Markdown"
+            )
+            return True
+        except ApiTelegramException as ex:
+            if ex.error_code == 403:
+                # Bot was kicked from the chat
+                self.db.set_digest(chat_id, False)
+            logging.error(f"Can't send digest to {chat_id}: {ex}")
+            return False
@@ -0,0 +1,153 @@
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from contextlib import ExitStack
+
+from wholeftbot.database import Database
+
+
+def _parse_args(argv):
+    """
+    Parse command line arguments of export subcommand
+    :param argv: arguments after "export"
+    :return:
+    """
+    parser = ArgumentParser(
+        prog="wholeftbot export", description="Export WhoLeftBot data"
+    )
+
+    parser.add_argument(
+        "table",
+        choices=list(Database.EXPORT_COLUMNS),
+        help="data to export",
+    )
+
+    parser.add_argument(
+        "--db",
+        dest="database",
+        help="path to SQLite database file",
+        default=os.path.join("database", "wholeftbot.sqlite"),
+        required=False,
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--format",
+        dest="format",
+        choices=["ndjson", "csv"],
+        help="output format",
+        default="ndjson",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--gzip",
+        dest="gzip",
+        action="store_true",
+        help="compress output with gzip",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--output",
+        dest="output",
+        help="path to output file, stdout by default",
+        default=None,
+        required=False,
+        metavar="FILE",
+    )
+
+    parser.add_argument(
+        "--tenant",
+        dest="tenants",
+        type=int,
+        action="append",
+        help="export only this tenant, can be repeated",
+        default=None,
+        required=False,
+        metavar="TENANT_ID",
+    )
+
+    parser.add_argument(
+        "--chat",
+        dest="chats",
+        type=int,
+        action="append",
+        help="export only this chat, can be repeated",
+        default=None,
+        required=False,
+        metavar="CHAT_ID",
+    )
+
+    parser.add_argument(
+        "--since",
+        dest="since",
+        help="export rows created at or after this UTC datetime",
+        default=None,
+        required=False,
+        metavar="DATETIME",
+    )
+
+    parser.add_argument(
+        "--until",
+        dest="until",
+        help="export rows created before this UTC datetime",
+        default=None,
+        required=False,
+        metavar="DATETIME",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        dest="chunk_size",
+        type=int,
+        help="number of rows fetched from database at once",
+        default=1000,
+        required=False,
+    )
+
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.database):
+        parser.error(f"database file '{args.database}' doesn't exist")
+    return args
+
+
+def _write_rows(output, output_format, columns, rows):
+    if output_format == "csv":
+        writer = csv.writer(output)
+        writer.writerow(columns)
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            output.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+            output.write("\n")
+
+
+def main(argv):
+    args = _parse_args(argv)
+    db = Database(args.database, readonly=True)
+    columns = Database.EXPORT_COLUMNS[args.table]
+    rows = db.export_rows(
+        args.table, args.tenants, args.chats, args.since, args.until, args.chunk_size
+    )
+
+    with ExitStack() as stack:
+        if args.output:
+            binary = stack.enter_context(open(args.output, "wb"))
+        else:
+            binary = sys.stdout.buffer
+        if args.gzip:
+            binary = stack.enter_context(gzip.GzipFile(fileobj=binary, mode="wb"))
+
+        output = io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        try:
+            _write_rows(output, args.format, columns, rows)
+        finally:
+            # Don't let the wrapper close stdout
+            output.flush()
+            output.detach()
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Deque, Dict
+
+
+class Timing:
+    """
+    Rolling window of durations
+    """
+
+    def __init__(self, window: int):
+        self.count: int = 0
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": sum(self.samples) / len(self.samples) if self.samples else 0.0,
+            "p99": self.percentile(0.99),
+            "max": max(self.samples, default=0.0),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe in-memory counters and timings
+    """
+
+    TIMING_WINDOW = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Counter = Counter()
+        self._timings: Dict[str, Timing] = {}
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = Timing(self.TIMING_WINDOW)
+            timing.add(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def percentile(self, name: str, p: float) -> float:
+        with self._lock:
+            timing = self._timings.get(name)
+            return timing.percentile(p) if timing else 0.0
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def timings(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: timing.summary() for name, timing in self._timings.items()}
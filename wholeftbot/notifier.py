@@ -0,0 +1,166 @@
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
+from telebot.types import User
+
+from wholeftbot import emoji, utils
+from wholeftbot.database import Database
+from wholeftbot.metrics import Metrics
+
+
+class _Pending:
+    """
+    Leaves collected during the debounce window of one chat
+    """
+
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.names: List[str] = []
+        self.overflow = 0
+
+
+class LeaveNotifier:
+    """
+    Sends notifications about left members, coalescing leaves during the debounce window
+    """
+
+    # Memory used by pending leaves is bounded by MAX_PENDING_CHATS * MAX_NAMES
+    MAX_NAMES = 50
+    MAX_PENDING_CHATS = 10000
+    MAX_PER_HOUR = 6
+    MESSAGE_LIMIT = 4000
+    SEND_ATTEMPTS = 3
+
+    def __init__(self, bot: TeleBot, db: Database, metrics: Metrics):
+        self.bot: TeleBot = bot
+        self.db: Database = db
+        self.metrics: Metrics = metrics
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._windows: Dict[int, int] = db.get_leave_notifications()
+        self._pending: Dict[int, _Pending] = {}
+        self._deadlines: List[Tuple[float, int]] = []
+        self._sent: Dict[int, Deque[float]] = {}
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="notifier", daemon=True)
+        thread.start()
+        return thread
+
+    def set_window(self, chat_id: int, debounce_seconds: Optional[int]):
+        """
+        Enable or disable notifications for the chat
+        :param chat_id: chat id
+        :param debounce_seconds: debounce window, None to disable
+        :return:
+        """
+        self.db.set_leave_notifications(chat_id, debounce_seconds)
+        with self._lock:
+            if debounce_seconds:
+                self._windows[chat_id] = debounce_seconds
+            else:
+                self._windows.pop(chat_id, None)
+                self._pending.pop(chat_id, None)
+                self._sent.pop(chat_id, None)
+
+    def get_window(self, chat_id: int) -> Optional[int]:
+        with self._lock:
+            return self._windows.get(chat_id)
+
+    def push(self, chat_id: int, user: User):
+        """
+        Add left member to the pending notification of the chat
+        :param chat_id: chat id
+        :param user: left member
+        :return:
+        """
+        with self._lock:
+            window = self._windows.get(chat_id)
+            if not window:
+                return
+
+            pending = self._pending.get(chat_id)
+            if pending is None:
+                if len(self._pending) >= self.MAX_PENDING_CHATS:
+                    self.metrics.incr("notifications.dropped")
+                    return
+                pending = self._pending[chat_id] = _Pending(time.monotonic() + window)
+                heapq.heappush(self._deadlines, (pending.deadline, chat_id))
+                self._wakeup.notify()
+
+            if len(pending.names) < self.MAX_NAMES:
+                pending.names.append(utils.user_name(user, mention=True))
+            else:
+                pending.overflow += 1
+
+    def _pop_due(self) -> Tuple[int, _Pending]:
+        """
+        Wait for the next closed window which chat is allowed to be notified
+        :return:
+        """
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                if not self._deadlines:
+                    self._wakeup.wait()
+                    continue
+                deadline, chat_id = self._deadlines[0]
+                if deadline > now:
+                    self._wakeup.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self._deadlines)
+                pending = self._pending.get(chat_id)
+                if pending is None or pending.deadline != deadline:
+                    # Notifications were disabled in the meantime
+                    continue
+
+                sent = self._sent.setdefault(chat_id, deque(maxlen=self.MAX_PER_HOUR))
+                while sent and sent[0] <= now - 60 * 60:
+                    sent.popleft()
+                if len(sent) >= self.MAX_PER_HOUR:
+                    # Keep collecting until the hourly limit allows the next message
+                    pending.deadline = sent[0] + 60 * 60
+                    heapq.heappush(self._deadlines, (pending.deadline, chat_id))
+                    self.metrics.incr("notifications.delayed")
+                    continue
+
+                sent.append(now)
+                del self._pending[chat_id]
+                return chat_id, pending
+
+    def _run(self):
+        while True:
+            chat_id, pending = self._pop_due()
+            try:
+                self._send(chat_id, self.render(pending))
+            except Exception as ex:  # pylint: disable=W0703
+                logging.error(f"Can't send leave notification to {chat_id}: {ex}")
+
+    @staticmethod
+    def render(pending: _Pending) -> str:
+        text = emoji.GOODBYE + " Из чата вышли:\n"
+        text += "\n".join(pending.names) + "\n"
+        if pending.overflow:
+            text += f"...и ещё {pending.overflow}\n"
+        return text
+
+    def _send(self, chat_id: int, text: str):
+        for chunk in utils.split_lines(text, self.MESSAGE_LIMIT):
+            try:
+                utils.send_message_with_retry(
+                    self.bot, chat_id, chunk, self.SEND_ATTEMPTS, parse_mode="Markdown"
+                )
+                self.metrics.incr("notifications.sent")
+            except ApiTelegramException as ex:
+                if ex.error_code == 403:
+                    # Bot was kicked from the chat
+                    self.set_window(chat_id, None)
+                raise
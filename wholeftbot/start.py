@@ -3,8 +3,13 @@ import os
 from argparse import ArgumentParser
 from logging.handlers import TimedRotatingFileHandler
 
+from wholeftbot.backup import BackupScheduler
+from wholeftbot.cluster import Cluster
 from wholeftbot.database import Database
+from wholeftbot.digest import DigestScheduler
 from wholeftbot.telegrambot import TelegramBot
+from wholeftbot.tenants import Tenants
+from wholeftbot.watchdog import HealthServer
 
 
 def _parse_args():
@@ -52,7 +57,16 @@ def _parse_args():
     )
 
     parser.add_argument(
-        "--token", dest="token", help="Telegram bot token", required=True, default=None
+        "--token", dest="token", help="Telegram bot token", required=False, default=None
+    )
+
+    parser.add_argument(
+        "--config",
+        dest="config",
+        help="path to JSON config with tokens of bots to run in one process",
+        default=None,
+        required=False,
+        metavar="FILE",
     )
 
     parser.add_argument(
@@ -73,7 +87,63 @@ def _parse_args():
         default=False,
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="run N worker processes partitioned by chat and a dedicated database writer process",
+        default=0,
+        required=False,
+        metavar="N",
+    )
+
+    parser.add_argument(
+        "--backup-dir",
+        dest="backup_dir",
+        help="directory for database backups",
+        default=os.path.join("database", "backups"),
+        required=False,
+        metavar="DIR",
+    )
+
+    parser.add_argument(
+        "--backup-interval",
+        dest="backup_interval",
+        type=float,
+        help="hours between scheduled database backups, 0 to make them only on demand",
+        default=0,
+        required=False,
+        metavar="HOURS",
+    )
+
+    parser.add_argument(
+        "--backup-keep",
+        dest="backup_keep",
+        type=int,
+        help="number of database backups to keep",
+        default=7,
+        required=False,
+        metavar="N",
+    )
+
+    parser.add_argument(
+        "--health-port",
+        dest="health_port",
+        type=int,
+        help="serve health of the bot on http://127.0.0.1:PORT/healthz",
+        default=0,
+        required=False,
+        metavar="PORT",
+    )
+
+    args = parser.parse_args()
+    if bool(args.token) == bool(args.config):
+        parser.error("exactly one of --token and --config is required")
+    if args.config and args.workers > 0:
+        parser.error("--workers can't be used with --config")
+    if args.health_port and args.workers > 0:
+        parser.error("--health-port can't be used with --workers")
+    return args
 
 
 class WhoLeftBot:
@@ -81,12 +151,35 @@ class WhoLeftBot:
         self.args = _parse_args()
         self._init_logger(self.args.logfile, self.args.loglevel)
         self.db = Database(self.args.database)
-        self.tgbot = TelegramBot(
-            self.args.token,
+        self.backups = BackupScheduler(
             self.db,
-            self.args.clean,
-            self.args.debug,
+            self.args.backup_dir,
+            self.args.backup_interval,
+            self.args.backup_keep,
         )
+        self.cluster = None
+        self.tenants = None
+        self.tgbot = None
+        if self.args.config:
+            self.tenants = Tenants(
+                self.args.config, self.db, self.backups, self.args.clean
+            )
+        elif self.args.workers > 0:
+            self.cluster = Cluster(
+                self.args.token,
+                self.args.database,
+                self.args.workers,
+                self.backups,
+                self.args.clean,
+            )
+        else:
+            self.tgbot = TelegramBot(
+                self.args.token,
+                self.db,
+                self.args.clean,
+                self.args.debug,
+            )
+            self.tgbot.backups = self.backups
 
     def _init_logger(self, logfile, level):
         """
@@ -121,6 +214,23 @@ class WhoLeftBot:
 
             logger.addHandler(file_log)
 
+    def _start_health_server(self, watchdogs):
+        if self.args.health_port:
+            HealthServer(watchdogs, self.args.health_port).start()
+
     def start(self):
+        self.backups.start()
+
+        if self.cluster:
+            self.cluster.run()
+            return
+
+        if self.tenants:
+            self._start_health_server([tgbot.watchdog for tgbot in self.tenants.bots])
+            self.tenants.start()
+            return
+
+        self._start_health_server([self.tgbot.watchdog])
+        DigestScheduler(self.tgbot.bot, self.db).start()
         self.tgbot.bot_start_polling()
         self.tgbot.bot_idle()
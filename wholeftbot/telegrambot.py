@@ -2,8 +2,10 @@ import importlib
 import logging
 import os
 import threading
+import time
 import traceback
-from typing import List
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional
 
 import telebot.types
 from telebot import TeleBot
@@ -14,8 +16,12 @@ from telebot.types import (
 )
 
 from wholeftbot import constants, emoji, utils
+from wholeftbot.backup import BackupScheduler
 from wholeftbot.commands import Command
 from wholeftbot.database import Database
+from wholeftbot.metrics import Metrics
+from wholeftbot.notifier import LeaveNotifier
+from wholeftbot.watchdog import Watchdog
 
 
 def threaded(fn):
@@ -27,25 +33,95 @@ def threaded(fn):
     return wrapper
 
 
+class FilteredTeleBot(TeleBot):
+    """
+    TeleBot that drops irrelevant messages before they are scheduled to the worker pool
+    """
+
+    def __init__(
+        self,
+        token,
+        message_filter: Callable[[Message], bool],
+        worker_pool: Optional[Executor] = None,
+        dispatch_listener: Optional[Callable[[Message], None]] = None,
+        **kwargs,
+    ):
+        # Handlers are run by the shared pool if it's given, instead of bot's own one
+        super().__init__(token, threaded=worker_pool is None, **kwargs)
+        self.message_filter = message_filter
+        self.shared_worker_pool: Optional[Executor] = worker_pool
+        self.dispatch_listener: Optional[Callable[[Message], None]] = dispatch_listener
+
+    def process_new_messages(self, new_messages):
+        new_messages = [m for m in new_messages if self.message_filter(m)]
+        if not new_messages:
+            return
+
+        # Notified before scheduling, so time spent in the queue of the pool is tracked
+        if self.dispatch_listener:
+            for message in new_messages:
+                self.dispatch_listener(message)
+
+        if self.shared_worker_pool:
+            for message in new_messages:
+                self.shared_worker_pool.submit(self._process_shared, message)
+        else:
+            super().process_new_messages(new_messages)
+
+    # pylint: disable=W0703
+    def _process_shared(self, message: Message):
+        try:
+            super().process_new_messages([message])
+        except Exception as ex:
+            logging.error(f"{ex} - {message}")
+
+
 class TelegramBot:
-    def __init__(self, token, db, clean=False, debug=False):
+    # Only these updates are handled, so don't let Telegram send anything else
+    ALLOWED_UPDATES = ["message"]
+    POLLING_TIMEOUT = 20
+    POLLING_ERROR_INTERVAL = 3
+
+    def __init__(
+        self,
+        token,
+        db,
+        clean=False,
+        debug=False,
+        register_commands=True,
+        worker_pool: Optional[Executor] = None,
+    ):
         self.token: str = token
         self.db: Database = db
         self.clean: bool = clean
         self.debug: bool = debug
+        self.register_commands: bool = register_commands
         self.commands: List[Command] = []
+        self.commands_index: Dict[str, Command] = {}
+        self.metrics: Metrics = Metrics()
+        self.backups: Optional[BackupScheduler] = None
+        self.watchdog: Watchdog = Watchdog(self)
+
+        # Polling thread is replaced when it stalls, the stale one exits once it wakes up
+        self._polling_lock = threading.Lock()
+        self._polling_generation = 0
+        self._offset: Optional[int] = None
 
-        self.bot: TeleBot = TeleBot(token, skip_pending=clean)
+        self.bot: TeleBot = FilteredTeleBot(
+            token, self._is_relevant, worker_pool, self.watchdog.dispatched
+        )
         self.me: User = self.bot.get_me()
         self.db.save_user_and_chat(self.me, None)
 
+        self.notifier: LeaveNotifier = LeaveNotifier(self.bot, self.db, self.metrics)
+        self.notifier.start()
+
         self._load_commands()
 
         self.bot.add_message_handler(
             {
-                "function": self._handle_text_messages,
+                "function": self.watchdog.track(self._handle_text_messages),
                 "filters": {
-                    "func": lambda m: m.text and not m.forward_from_chat,
                     "content_types": ["text"],
                 },
                 "pass_bot": False,
@@ -54,24 +130,91 @@ class TelegramBot:
 
         self.bot.add_message_handler(
             {
-                "function": self._handle_left_chat_member,
+                "function": self.watchdog.track(self._handle_left_chat_member),
                 "filters": {
                     "content_types": ["left_chat_member"],
                 },
             }
         )
 
+        self.bot.add_message_handler(
+            {
+                "function": self.watchdog.track(self._handle_new_chat_members),
+                "filters": {
+                    "content_types": ["new_chat_members"],
+                },
+            }
+        )
+
     # Start the bot
     def bot_start_polling(self):
+        self.watchdog.start()
         for admin in constants.ADMINS:
             self.bot.send_message(admin, emoji.INFO + " I was restarted")
 
     # Go in idle mode
     def bot_idle(self):
-        if self.debug:
-            self.bot.polling(True, True)
-        else:
-            self.bot.infinity_polling()
+        if self.clean or self.debug:
+            updates = self.bot.get_updates(
+                offset=-1, timeout=self.POLLING_TIMEOUT, long_polling_timeout=1
+            )
+            if updates:
+                self._offset = updates[-1].update_id + 1
+
+        self.restart_polling()
+        # Polling runs in its own threads, so just wait here
+        threading.Event().wait()
+
+    # Start a new polling thread, the current one is abandoned even if it hangs in a request
+    def restart_polling(self):
+        with self._polling_lock:
+            self._polling_generation += 1
+            generation = self._polling_generation
+
+        threading.Thread(
+            target=self._poll,
+            args=(generation,),
+            name=f"polling-{generation}",
+            daemon=True,
+        ).start()
+
+    def _poll(self, generation: int):
+        # Each thread has its own HTTP session in telebot, so a stuck connection isn't reused
+        while generation == self._polling_generation:
+            try:
+                updates = self.bot.get_updates(
+                    offset=self._offset,
+                    timeout=self.POLLING_TIMEOUT,
+                    allowed_updates=self.ALLOWED_UPDATES,
+                    long_polling_timeout=self.POLLING_TIMEOUT,
+                )
+            except Exception as ex:  # pylint: disable=W0703
+                logging.error(f"Polling failed: {ex}")
+                time.sleep(self.POLLING_ERROR_INTERVAL)
+                continue
+
+            with self._polling_lock:
+                if generation != self._polling_generation:
+                    return
+                # Updates could be already handled by the thread which replaced this one
+                if self._offset is not None:
+                    updates = [u for u in updates if u.update_id >= self._offset]
+                if updates:
+                    self._offset = updates[-1].update_id + 1
+            self.watchdog.poll_finished()
+
+            self.bot.process_new_updates(updates)
+            self._raise_handler_exceptions()
+
+    def _raise_handler_exceptions(self):
+        # Own worker pool of the bot keeps exceptions of handlers until they are cleared
+        if not self.bot.threaded:
+            return
+        try:
+            self.bot.worker_pool.raise_exceptions()
+        except Exception as ex:  # pylint: disable=W0703
+            logging.error(f"Handler failed: {ex}")
+            self.bot.worker_pool.clear_exceptions()
 
     def _load_commands(self):
         threads = []
@@ -89,6 +232,15 @@ class TelegramBot:
         for thread in threads:
             thread.join()
 
+        commands_index = {}
+        for action in self.commands:
+            for cmd in action.get_cmds():
+                commands_index[cmd] = action
+        self.commands_index = commands_index
+
+        if not self.register_commands:
+            return
+
         commands = []
         for action in self.commands:
             if len(action.get_cmds()) == 0 or not action.get_description():
@@ -131,25 +283,46 @@ class TelegramBot:
             for chunk in utils.chunks(error_msg, 3000):
                 self.bot.send_message(admin, chunk, parse_mode="HTML")
 
+    def _is_relevant(self, message: Message) -> bool:
+        """
+        Classify message before it is scheduled to the worker pool
+        :param message: Message
+        :return: False if message should be dropped
+        """
+        self.metrics.incr("updates.received")
+        self.watchdog.update_received()
+
+        relevant = False
+        if message.content_type in ("left_chat_member", "new_chat_members"):
+            relevant = message.chat.type != "private"
+        elif message.content_type == "text" and not message.forward_from_chat:
+            parsed = utils.parse_command(message)
+            if parsed:
+                cmd, at_mention = parsed
+                if at_mention is None or at_mention == self.me.username:
+                    relevant = cmd in self.commands_index
+                    # Handler reads it with utils.cached_command
+                    utils.cache_command(message, cmd)
+
+        if not relevant:
+            self.metrics.incr("updates.dropped")
+        return relevant
+
     def _handle_text_messages(self, message: Message):
         """
         Handle text messages
         :param message: Message
         :return:
         """
-        if not message or not message.text:
+        # Set by _is_relevant, which runs for every message before this handler
+        cmd = utils.cached_command(message)
+        if cmd is None:
             return
 
-        if message.text.startswith("/"):
-            at_mention = utils.get_atmention(message)
-            if at_mention and at_mention != self.me.username:
-                return
-
-            cmd = utils.get_command(message)
-            for command in self.commands:
-                if cmd in command.get_cmds():
-                    command.call(message)
-                    return
+        command = self.commands_index.get(cmd)
+        if command:
+            self.metrics.incr("commands.dispatched")
+            command.call(message)
 
     def _handle_left_chat_member(self, message: Message):
         """
@@ -166,3 +339,20 @@ class TelegramBot:
             return
 
         self.db.left_member_log(user, chat)
+        self.notifier.push(chat.id, user)
+
+    def _handle_new_chat_members(self, message: Message):
+        """
+        Handle new chat members event
+        :param message:
+        :return:
+        """
+        users = message.new_chat_members
+        if not users:
+            return
+
+        chat = message.chat
+        if chat.type == "private":
+            return
+
+        self.db.join_members_log(users, chat)
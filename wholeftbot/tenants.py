@@ -0,0 +1,60 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from wholeftbot.backup import BackupScheduler
+from wholeftbot.database import Database
+from wholeftbot.digest import DigestScheduler
+from wholeftbot.telegrambot import TelegramBot
+
+
+class Tenants:
+    """
+    Multi-tenant mode: many bots in one process, sharing the database and the worker pool
+
+    Config file format:
+    {"workers": 8, "bots": [{"token": "...", "tenant_id": 0}, {"token": "..."}]}
+    tenant_id defaults to the bot id, use 0 for the bot which data was saved before
+
+    Writes of all bots go through the single locked writer connection of the database,
+    not through a write queue: a short lock per write is cheaper than a queue thread here
+    """
+
+    DEFAULT_WORKERS = 8
+
+    def __init__(
+        self, config_path, db: Database, backups: BackupScheduler, clean=False
+    ):
+        with open(config_path, encoding="utf-8") as file:
+            config = json.load(file)
+
+        self.worker_pool = ThreadPoolExecutor(
+            config.get("workers", self.DEFAULT_WORKERS), thread_name_prefix="handler"
+        )
+        self.bots: List[TelegramBot] = []
+        for bot_config in config["bots"]:
+            token = bot_config["token"]
+            tenant_id = bot_config.get("tenant_id", int(token.split(":")[0]))
+            tgbot = TelegramBot(
+                token, db.for_tenant(tenant_id), clean, worker_pool=self.worker_pool
+            )
+            tgbot.backups = backups
+            self.bots.append(tgbot)
+
+    def start(self):
+        threads = []
+        for tgbot in self.bots:
+            DigestScheduler(tgbot.bot, tgbot.db).start()
+            tgbot.bot_start_polling()
+
+            thread = threading.Thread(
+                target=tgbot.bot_idle,
+                name=f"polling-{tgbot.me.username}",
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
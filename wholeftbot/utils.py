@@ -1,22 +1,49 @@
 import datetime
 import html
 import re
-from typing import Union
+import time
+from typing import Optional, Tuple, Union
 
+from telebot import TeleBot
+from telebot.apihelper import ApiTelegramException
 from telebot.types import Message, User
 
 from wholeftbot.database import User as DBUser
 
 
-def get_command(message: Message):
-    return message.text.split(" ")[0].split("@")[0][1:].lower()
+def parse_command(message: Message) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Parse bot command from the message entities in a single pass
+    :param message: Message
+    :return: (command, at_mention) or None if message doesn't start with a command
+    """
+    if not message.entities or not message.text:
+        return None
 
+    entity = message.entities[0]
+    if entity.type != "bot_command" or entity.offset != 0:
+        return None
 
-def get_atmention(message: Message):
-    if "@" in message.text:
-        command = message.text.split(" ")[0].split("@")
-        return command[1] if len(command) > 1 else None
-    return None
+    command, _, at_mention = message.text[1 : entity.length].partition("@")
+    return command.lower(), at_mention or None
+
+
+# Command parsed by the pre-dispatch filter is cached on the message under this name,
+# so handlers don't parse the text again. Use cache_command/cached_command to access it
+CACHED_COMMAND_ATTR = "_wholeftbot_command"
+
+
+def cache_command(message: Message, command: str):
+    setattr(message, CACHED_COMMAND_ATTR, command)
+
+
+def cached_command(message: Message) -> Optional[str]:
+    """
+    Command cached by cache_command
+    :param message: Message
+    :return: command or None if the message was not classified as a command
+    """
+    return getattr(message, CACHED_COMMAND_ATTR, None)
 
 
 def chunks(s, n):
@@ -25,6 +52,40 @@ def chunks(s, n):
         yield s[start : start + n]
 
 
+def split_lines(text: str, n: int):
+    """Produce chunks of `text` no longer than `n`, splitting only between lines."""
+    chunk = ""
+    for line in text.splitlines(keepends=True):
+        if chunk and len(chunk) + len(line) > n:
+            yield chunk
+            chunk = ""
+        chunk += line
+    if chunk:
+        yield chunk
+
+
+def send_message_with_retry(
+    bot: TeleBot, chat_id: int, text: str, attempts: int, **kwargs
+) -> Message:
+    """
+    Send message, waiting for retry_after when Telegram limits the bot
+    :param bot: TeleBot
+    :param chat_id: chat id
+    :param text: message text
+    :param attempts: number of attempts
+    :param kwargs: send_message arguments
+    :return: sent message, ApiTelegramException is raised if it can't be sent
+    """
+    for attempt in range(attempts):
+        try:
+            return bot.send_message(chat_id, text, **kwargs)
+        except ApiTelegramException as ex:
+            if ex.error_code != 429 or attempt == attempts - 1:
+                raise
+            parameters = ex.result_json.get("parameters", {})
+            time.sleep(parameters.get("retry_after", 5))
+
+
 def user_name(
     user: Union[User, DBUser],
     with_username=False,
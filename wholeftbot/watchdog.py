@@ -0,0 +1,184 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+from telebot.types import Message
+
+from wholeftbot import constants, emoji
+
+
+class Watchdog:
+    """
+    Watches polling and handlers of the bot, alerts admins and restarts stalled polling
+    """
+
+    CHECK_INTERVAL = 15
+    ALERT_INTERVAL = 15 * 60
+    # Long polling returns at least every 20 seconds, even without updates
+    POLL_STALL_SECONDS = 120
+    # Messages are in flight from dispatch to the end of the handler, so waiting in the
+    # queue of the worker pool counts too: a few threads handle far less than that normally
+    MAX_IN_FLIGHT = 50
+    MAX_HANDLER_AGE = 60
+    HANDLER_P99_SLO = 5
+
+    def __init__(self, telegram_bot):
+        self.tgb = telegram_bot
+        self.started_at: float = time.monotonic()
+        self.last_update_at: float = 0
+        self.last_poll_at: float = self.started_at
+        self.last_alert_at: float = 0
+        self.last_restart_at: float = 0
+
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Tuple[int, int], float] = {}
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        thread.start()
+        return thread
+
+    def update_received(self):
+        self.last_update_at = time.monotonic()
+
+    def poll_finished(self):
+        self.last_poll_at = time.monotonic()
+
+    def dispatched(self, message: Message):
+        """
+        Start tracking the message when it is scheduled to the worker pool
+        :param message: Message
+        :return:
+        """
+        with self._lock:
+            self._in_flight[(message.chat.id, message.message_id)] = time.monotonic()
+
+    def track(self, func: Callable) -> Callable:
+        """
+        Wrap handler to track latency of the message from its dispatch to the end of handler
+        :param func: handler
+        :return:
+        """
+
+        def _tracked(message: Message, *args, **kwargs):
+            try:
+                return func(message, *args, **kwargs)
+            finally:
+                with self._lock:
+                    started = self._in_flight.pop(
+                        (message.chat.id, message.message_id), None
+                    )
+                if started is not None:
+                    self.tgb.metrics.observe("handler", time.monotonic() - started)
+
+        return _tracked
+
+    def health(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            in_flight = len(self._in_flight)
+            oldest = min(self._in_flight.values(), default=now)
+
+        since_last_poll = now - self.last_poll_at
+        handler_p99 = self.tgb.metrics.percentile("handler", 0.99)
+
+        problems = []
+        if since_last_poll > self.POLL_STALL_SECONDS:
+            problems.append(f"no polling for {since_last_poll:.0f}s")
+        if in_flight > self.MAX_IN_FLIGHT:
+            problems.append(f"{in_flight} messages in flight")
+        if now - oldest > self.MAX_HANDLER_AGE:
+            problems.append(f"message in flight for {now - oldest:.0f}s")
+        if handler_p99 > self.HANDLER_P99_SLO:
+            problems.append(f"handlers p99 is {handler_p99:.1f}s")
+
+        return {
+            "bot": self.tgb.me.username,
+            "healthy": not problems,
+            "problems": problems,
+            "since_last_update": (
+                now - self.last_update_at if self.last_update_at else None
+            ),
+            "since_last_poll": since_last_poll,
+            "in_flight": in_flight,
+            "oldest_in_flight": now - oldest,
+            "handler_p99": handler_p99,
+        }
+
+    def _run(self):
+        while True:
+            time.sleep(self.CHECK_INTERVAL)
+            try:
+                self.check()
+            except Exception as ex:  # pylint: disable=W0703
+                logging.error(f"Watchdog check failed: {ex}")
+
+    def check(self):
+        health = self.health()
+        if health["healthy"]:
+            return
+
+        text = f"{emoji.WARNING} @{health['bot']}: " + ", ".join(health["problems"])
+        logging.warning(text)
+
+        now = time.monotonic()
+        # Restarted polling is given time to complete a request before the next restart,
+        # health stays bad until it does
+        if (
+            health["since_last_poll"] > self.POLL_STALL_SECONDS
+            and now - self.last_restart_at > self.POLL_STALL_SECONDS
+        ):
+            self.last_restart_at = now
+            self.tgb.metrics.incr("polling.restarts")
+            self.tgb.restart_polling()
+
+        if now - self.last_alert_at < self.ALERT_INTERVAL:
+            return
+        self.last_alert_at = now
+        for admin in constants.ADMINS:
+            self.tgb.bot.send_message(admin, text)
+
+
+class HealthServer:
+    """
+    Serves health of the bots as JSON on /healthz
+    """
+
+    def __init__(self, watchdogs: List[Watchdog], port: int, host="127.0.0.1"):
+        self.watchdogs: List[Watchdog] = watchdogs
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    def _handler_class(self):
+        watchdogs = self.watchdogs
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=C0103
+                if self.path != "/healthz":
+                    self.send_error(404)
+                    return
+
+                bots = [watchdog.health() for watchdog in watchdogs]
+                healthy = all(bot["healthy"] for bot in bots)
+                body = json.dumps({"healthy": healthy, "bots": bots}).encode()
+
+                self.send_response(200 if healthy else 503)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=W0622
+                logging.debug(format % args)
+
+        return _Handler
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.server.serve_forever, name="healthz", daemon=True
+        )
+        thread.start()
+        return thread